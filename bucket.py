@@ -27,8 +27,21 @@ from __future__ import print_function
 
 class bucket(object):
     matrix_adj = {}  # represent the network topology in matrix
+    topology_version = 0 # moves whenever a link or switch comes or goes
     path_list = {}   # contains paths of all switch pairs
+    link_path = {}   # map each directed link to the paths using it
+    switch_path = {} # map each switch to the paths passing it
+    path_pool = {}   # interned hop tuples shared by the paths
+    path_refs = {}   # number of indexed paths using each interned tuple
+    path_rank = {}   # paths of each switch pair sorted widest first
+    path_version = 0 # moves whenever a path is added or removed
     port_info = {}   # contains all ports for each switch in detail
+    load_epoch = 0   # moves whenever a link load changes
     arp_table = {}   # map ip address to mac address
     flow_entry = {}  # contains all flow entry which stored in the switches
-    gateway = {}
\ No newline at end of file
+    flows = {}       # map each cookie to its flow and all of its hops
+    gateway = {}
+    gateway_epoch = 0    # moves when a gateway flips or its load changes
+    gateway_table = {}   # best gateways of each ingress switch
+    latency = {}         # latency histogram of each measured step
+    history = {}         # load time series of each port and link
\ No newline at end of file
@@ -30,6 +30,11 @@ import time
 
 from pox.core import core
 from bucket import bucket
+import routing
+from config import config
+from lib import Latency
+from forwarding import FlowInstaller
+from monitor import History
 
 class cli(object):
 
@@ -39,7 +44,7 @@ class cli(object):
             for j in bucket.path_list[i] :
                 print('    destination', j)
                 for k in bucket.path_list[i][j]:
-                    print('        ',k.path, k.get_metric())
+                    print('        ',list(k.path), k.get_metric())
 
     def print_matrix_adj():
         for i in bucket.matrix_adj:
@@ -61,15 +66,48 @@ class cli(object):
             print('source', i)
             for j in bucket.path_list[i] :
                 print('    destination', j)
-                for k in bucket.path_list[i][j]:
-                    print('        ',k.path, k.get_metric_SNH())
+                for k, metric in routing.DFS.getMetric_SNH(i, j):
+                    print('        ',list(k.path), metric)
+
+    def print_installer():
+        for i in sorted(FlowInstaller.counter):
+            print('%s : %s' % (i, FlowInstaller.counter[i]))
+        print('in flight : %s' % len(FlowInstaller.active))
+
+    def print_latency():
+        for i in sorted(bucket.latency):
+            print('%s : %s' % (i, bucket.latency[i]))
+
+    def dump_latency():
+        Latency.dump(config.LATENCY_DUMP)
+        print('latency histograms written to %s' % config.LATENCY_DUMP)
+
+    def print_history():
+        # latest mean and the peak kept at each resolution
+        for i in sorted(bucket.history):
+            print('%s %s - %s' % i)
+            for ring in bucket.history[i].rings:
+                series = ring.series()
+                if series:
+                    print('    %ss : mean %s, peak %s' % (ring.step,
+                                                          series[-1][1],
+                                                          max(j[2] for j in series)))
+
+    def dump_history():
+        History.export(config.HISTORY_DUMP)
+        print('load history written to %s' % config.HISTORY_DUMP)
 
     prompt = 'drox> '
     command_dict = {'show path': print_path,\
                     'show matrix': print_matrix_adj,\
                     'show port': print_port_info,\
                     'show arp': print_arp,\
-                    'snh path': print_path_SNH}
+                    'snh path': print_path_SNH,\
+                    'show installer': print_installer,\
+                    'show latency': print_latency,\
+                    'dump latency': dump_latency,\
+                    'show history': print_history,\
+                    'dump history': dump_history}
 
     @classmethod
     def main(cls):
@@ -32,9 +32,28 @@ class config(object):
     USE_STATIC_IP = False
     USE_VLAN = False
 
-    # Ethernet Routing (choose one): {'DFS', 'Djisktra'}
+    # Ethernet Routing (choose one): {'DFS', 'KSP', 'Djisktra'}
     LOCAL_ROUTING = 'DFS'
 
+    # KSP keeps only the K shortest paths of each switch pair,
+    # none of them longer than KSP_MAX_HOP hops
+    KSP_K = 4
+    KSP_MAX_HOP = 8
+
+    # number of worker processes computing the paths of DFS/KSP off the
+    # event loop (0 computes them on the event loop); a job without an
+    # answer after ROUTING_TIMEOUT seconds is dropped with its pool
+    ROUTING_WORKERS = 0
+    ROUTING_TIMEOUT = 60
+
+    # evaluate the path metrics of DFS/KSP with NumPy arrays
+    USE_NUMPY = False
+
+    # spread new flows of DFS/KSP over the MULTIPATH_K widest paths of the
+    # switch pair, weighted by residual capacity
+    MULTIPATH = False
+    MULTIPATH_K = 3
+
     # contains entries of switch used as gateway
     USE_GATEWAY = False
 
@@ -45,4 +64,89 @@ class config(object):
     BGP_GATEWAY = {}
 
     USE_STATIC_GATEWAY = True
-    STATIC_GATEWAY = {}
\ No newline at end of file
+    # dpid : {'port_no': 4, 'ip_addr': '10.0.0.2', 'next_hop': '10.0.0.1'}
+    STATIC_GATEWAY = {}
+
+    # granularity of the installed rules (choose one):
+    # 'flow' (exact match), 'host_pair' (nw_src, nw_dst) or 'destination' (nw_dst)
+    # multipath and gateway choices follow the same granularity
+    FLOW_GRANULARITY = 'flow'
+
+    # pre-install per-destination rules towards every learned host,
+    # checked again every PROACTIVE_REFRESH seconds and on topology changes
+    PROACTIVE = False
+    PROACTIVE_PRIORITY = 40
+    PROACTIVE_REFRESH = 10
+
+    # packet-ins of a flow whose setup is still in flight are held (up to
+    # SETUP_COALESCE_BUFFER of them) for SETUP_COALESCE_WINDOW seconds and
+    # sent through the new rules once they are installed (0 disables)
+    SETUP_COALESCE_WINDOW = 1.
+    SETUP_COALESCE_BUFFER = 16
+
+    # 16-bit prefix of the cookies of this controller instance
+    # (random when None)
+    COOKIE_PREFIX = None
+
+    # bytes of a table-miss packet sent to the controller; buffered packets
+    # are released by buffer_id, so only switches without buffers need the
+    # whole packet (None keeps the switch setting)
+    MISS_SEND_LEN = 128
+
+    # timeouts of reactive rules follow the mean rate of the flow over its
+    # last TIMEOUT_SAMPLES stats replies (or of the last flow with the same
+    # key): the last (min bps, idle, hard) entry the rate reaches applies,
+    # a hard timeout of 0 never expires
+    ADAPTIVE_TIMEOUT = False
+    TIMEOUT_POLICY = [(0, 5, 20), (10**5, 10, 60), (10**6, 10, 0)]
+    TIMEOUT_SAMPLES = 10
+
+    # every REBALANCE_INTERVAL seconds up to REBALANCE_MAX flows sending at
+    # least ELEPHANT_RATE bps are moved to a path whose bottleneck is
+    # REBALANCE_GAIN times wider than their own (DFS and KSP only)
+    REBALANCE = False
+    ELEPHANT_RATE = 10**7
+    REBALANCE_INTERVAL = 5
+    REBALANCE_GAIN = 1.5
+    REBALANCE_MAX = 1
+
+    # link load is measured from per-flow byte counters ('flow') or from
+    # the tx byte counters of the ports ('port'); in 'port' mode flow stats
+    # are only polled every FLOW_STATS_INTERVAL seconds for the flow rates
+    LOAD_MEASUREMENT = 'flow'
+    FLOW_STATS_INTERVAL = 5
+
+    # the load of every port and link is sampled each second into fixed
+    # rings of (step seconds, steps kept): 5 min of seconds, 6 h of minutes
+    # and a week of hours ('show history', 'dump history' to HISTORY_DUMP)
+    HISTORY = True
+    HISTORY_RESOLUTIONS = [(1, 300), (60, 360), (3600, 168)]
+    HISTORY_DUMP = 'history.txt'
+
+    # flow and port rates are smoothed with an EWMA, RATE_ALPHA is the
+    # weight of the newest sample (1 keeps the raw rates)
+    RATE_ALPHA = 0.5
+
+    # the load stats of each switch are polled every POLL_MIN_INTERVAL to
+    # POLL_MAX_INTERVAL seconds: faster while its ports move by more than
+    # POLL_CHANGE of their capacity or carry more than POLL_BUSY of it.
+    # At most POLL_MAX_OUTSTANDING requests wait for a reply, a request
+    # unanswered after POLL_TIMEOUT seconds is given up
+    POLL_MIN_INTERVAL = 1.
+    POLL_MAX_INTERVAL = 5.
+    POLL_CHANGE = 0.05
+    POLL_BUSY = 0.7
+    POLL_MAX_OUTSTANDING = 16
+    POLL_TIMEOUT = 3.
+
+    # seconds a flow setup may wait for its barrier replies
+    INSTALL_TIMEOUT = 5
+
+    # keep latency histograms of packet-in handling, path lookup and flow
+    # setup ('show latency' in the cli, 'dump latency' writes LATENCY_DUMP)
+    LATENCY_STATS = True
+    LATENCY_DUMP = 'latency.txt'
+
+    # outbound flows of each switch are spread over its GATEWAY_K best
+    # gateways, weighted by residual capacity
+    GATEWAY_K = 2
\ No newline at end of file
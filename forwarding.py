@@ -25,13 +25,16 @@ This component provides forwarding function
 """
 
 from __future__ import print_function
-from random import randint
+import struct
+import time
+from collections import OrderedDict
 
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from config import config
 from bucket import bucket
 import routing
+import misc
 
 import pox.lib.packet as pkt
 from pox.lib.addresses import IPAddr,EthAddr
@@ -40,63 +43,143 @@ from lib import *
 
 class Forwarding(object):
 
+    pending = {} # (ingress dpid, flow key) -> setup being installed
+
     def send_flow_mod(self, dpid, msg):
         core.openflow.sendToDPID(dpid, msg)
 
     @classmethod
-    def _handle_internal(cls, event):
+    def getPath(cls, src, dst, key = None):
+        if config.MULTIPATH and key is not None and \
+           config.LOCAL_ROUTING in ('DFS', 'KSP'):
+            return routing.Multipath.getPath(src, dst, key)
+        if config.LOCAL_ROUTING == 'DFS':
+            # print('DFS')
+            # return routing.DFS.getPath(src, dst)
+            return routing.DFS.getPath_SNH(src, dst)
+        elif config.LOCAL_ROUTING == 'KSP':
+            return routing.KSP.getPath_SNH(src, dst)
+        elif config.LOCAL_ROUTING == 'Djisktra':
+            return routing.Djisktra.getPath(src, dst)
+
+    @classmethod
+    def build_match(cls, event):
+        if config.FLOW_GRANULARITY == 'flow':
+            return of.ofp_match.from_packet(event.parsed)
+        # wildcarded rule shared by every flow towards the host (pair)
+        match = of.ofp_match()
+        match.dl_type = pkt.ethernet.IP_TYPE
+        match.nw_dst = event.parsed.next.dstip
+        if config.FLOW_GRANULARITY == 'host_pair':
+            match.nw_src = event.parsed.next.srcip
+        return match
+
+    @classmethod
+    def flow_key(cls, match):
+        return '%s %s %s %s %s' % (match.nw_src, match.nw_dst, match.nw_proto,
+                                   match.tp_src, match.tp_dst)
+
+    @classmethod
+    def _record_flow(cls, msg, path, key, hops):
+        record = FlowRecord(msg.cookie, msg.match, msg.priority, path, key)
+        record.actions = dict(hops)
+        record.timeouts = (msg.idle_timeout, msg.hard_timeout)
+        for dpid in path:
+            if msg.cookie in bucket.flow_entry[dpid]:
+                record.hops[dpid] = bucket.flow_entry[dpid][msg.cookie]
+        if record.hops:
+            bucket.flows[msg.cookie] = record
 
-        def getPath(src, dst):
-            if config.LOCAL_ROUTING == 'DFS':
-                # print('DFS')
-                # return routing.DFS.getPath(src, dst)
-                return routing.DFS.getPath_SNH(src, dst)
-            elif config.LOCAL_ROUTING == 'Djisktra':
-                pass
+    @classmethod
+    def delete_flow(cls, cookie):
+        # OpenFlow 1.0 ignores the cookie of a delete, each hop is deleted
+        # by its exact match instead
+        record = bucket.flows.pop(cookie, None)
+        if record is None:
+            return
+        for dpid in record.hops:
+            msg = of.ofp_flow_mod()
+            msg.command = of.OFPFC_DELETE_STRICT
+            msg.priority = record.priority
+            msg.match = record.match
+            core.openflow.sendToDPID(dpid, msg)
+            bucket.flow_entry.get(dpid, {}).pop(cookie, None)
+
+    @classmethod
+    def _hold(cls, event, key):
+        # packets of a flow whose setup is in flight wait for it to finish
+        setup = cls.pending.get((event.dpid, key))
+        if setup is None or \
+           time.time() - setup.start > config.SETUP_COALESCE_WINDOW:
+            return False
+        if len(setup.held) < config.SETUP_COALESCE_BUFFER:
+            setup.held.append(event.ofp)
+        return True
+
+    @classmethod
+    def _install(cls, event, key, msg, hops):
+        if config.SETUP_COALESCE_WINDOW <= 0:
+            FlowInstaller.install(msg, hops, event.ofp)
+            return
+        pending_key = (event.dpid, key)
+        def release(setup):
+            if cls.pending.get(pending_key) is setup:
+                del cls.pending[pending_key]
+            if setup.error:
+                return # the held packets are dropped
+            for ofp in setup.held:
+                if ofp.buffer_id is None and not ofp.is_complete:
+                    print('packet-in at %s truncated and not buffered, dropped' % event.dpid)
+                    continue
+                po = of.ofp_packet_out(data = ofp)
+                po.actions.append(of.ofp_action_output(port = of.OFPP_TABLE))
+                core.openflow.sendToDPID(event.dpid, po)
+        cls.pending[pending_key] = FlowInstaller.install(msg, hops, event.ofp,
+                                                         release)
+
+    @classmethod
+    def _handle_internal(cls, event):
+        match = cls.build_match(event)
+        key = cls.flow_key(match)
+        if cls._hold(event, key):
+            return
 
         try: # coba dulu udah ada routing table-nya belum.
             if event.dpid == bucket.arp_table[event.parsed.next.dstip].dpid:
                 path = [event.dpid]
             else:
-                path = [event.dpid] + getPath(event.dpid, bucket.arp_table[event.parsed.next.dstip].dpid)
+                start = time.time()
+                path = [event.dpid] + cls.getPath(event.dpid, bucket.arp_table[event.parsed.next.dstip].dpid, key)
+                Latency.add('path lookup', time.time() - start)
         except:
             try:
                 core.main._routing()
-                path = [event.dpid] + getPath(event.dpid, bucket.arp_table[event.parsed.next.dstip].dpid)
+                path = [event.dpid] + cls.getPath(event.dpid, bucket.arp_table[event.parsed.next.dstip].dpid, key)
             except:
                 print('Tidak ada di tabel routing [%s]' % event.parsed)
                 return
 
         msg = of.ofp_flow_mod()
         msg.priority = 42
-        msg.match = of.ofp_match.from_packet(event.parsed)
+        msg.match = match
         msg.idle_timeout = 10
         msg.hard_timeout = 20
+        Timeouts.apply(msg, key)
 
-        # used = False
-        # while(not used):
-        #     cookie = randint(0,2**64-1) # ukuran cookie itu 64 bit, dengan all 1s is reserved
-        #     for dpid_cek in bucket.flow_entry:
-        #         if cookie in bucket.flow_entry[dpid_cek]:
-        #             used = False
-        #             break
-        #         else:
-        #             used = True
-        #     if used:
-        #         break
-        cookie = randint(0,2**64-1) # ukuran cookie itu 64 bit, dengan all 1s is reserved
+        msg.cookie = Cookie.allocate()
 
+        hops = []
         for i in reversed(range(len(path))):
             msg.actions = []
             if i == 0:
                 msg.in_port = event.port
-                msg.data = event.ofp # terlalu beresiko
-                # print('    keluarin data dari buffer')
             else:
                 msg.in_port = bucket.matrix_adj[path[i]][path[i-1]].interface
-                msg.data = None
 
-            if not event.parsed.next.srcip.inNetwork('172.16.0.0/23'):
+            # a per-destination rule is shared by every source, so it always
+            # carries the rewrite external sources need
+            if config.FLOW_GRANULARITY == 'destination' or \
+               not event.parsed.next.srcip.inNetwork('172.16.0.0/23'):
                 msg.actions.append(of.ofp_action_dl_addr.set_dst(bucket.arp_table[event.parsed.next.dstip].mac_addr))
 
             if i == len(path)-1:
@@ -106,8 +189,8 @@ class Forwarding(object):
                 msg.actions.append(of.ofp_action_output(port = bucket.matrix_adj[path[i]][path[i+1]].interface))
                 msg_outport = bucket.matrix_adj[path[i]][path[i+1]].interface
 
-            core.openflow.sendToDPID(path[i], msg)
-            if msg.match.nw_src in bucket.arp_table:
+            hops.insert(0, (path[i], msg.actions))
+            if msg.match.nw_src is None or msg.match.nw_src in bucket.arp_table:
                 bucket.flow_entry[path[i]][msg.cookie] = FlowEntry(msg.match.nw_src,\
                                                                    msg.match.nw_dst,\
                                                                    msg.match.nw_proto,\
@@ -125,52 +208,45 @@ class Forwarding(object):
                                                                    msg.in_port,\
                                                                    msg_outport,\
                                                                    path,\
-                                                                   dpid = path[i])                                    
+                                                                   dpid = path[i])
+
+        cls._record_flow(msg, path, key, hops)
+        cls._install(event, key, msg, hops)
 
     @classmethod
     def _handle_external(cls, event):
-
-        gw = algorithm.get_gw(event.dpid)
+        match = cls.build_match(event)
+        key = cls.flow_key(match)
+        if cls._hold(event, key):
+            return
+        start = time.time()
+        gw, path = routing.Gateway.get_gw(event.dpid, key)
+        Latency.add('gateway lookup', time.time() - start)
 
         if gw == None: # Gateway is not available or there is no path from dpid_src onto the gateway
             return
+        path = [event.dpid] + path
 
-        try: # coba dulu udah ada routing table-nya belum.
-            if event.dpid == gw:
-                path = [event.dpid]
-            else:
-                path = [event.dpid] + algorithm.get_path_01(event.dpid, gw)
-        except:
-            try:
-                core.main._findPaths()
-                path = [event.dpid] + algorithm.get_path_01(event.dpid, gw)
-            except:
-                print('Tidak ada di tabel routing')
+        gateway = bucket.gateway[gw]
+        if gateway.next_hop not in bucket.arp_table:
+            # the packet is dropped, next ones go out once the next hop replies
+            misc.ARP.request_arp(gateway.next_hop, gateway.port_no, gw,
+                                 gateway.ip_addr, EthAddr('02:00:00:00:00:24'))
+            return
 
         msg = of.ofp_flow_mod()
         msg.priority = 42
-        msg.match = of.ofp_match.from_packet(event.parsed)
+        msg.match = match
         msg.idle_timeout = 10
         msg.hard_timeout = 60
+        Timeouts.apply(msg, key)
 
-        used = True
-        while(used):
-            cookie = randint(0,2**64-1) # ukuran cookie itu 64 bit, dengan all 1s is reserved
-            for dpid_cek in bucket.flow_entry:
-                if cookie in bucket.flow_entry[dpid_cek]:
-                    used = True
-                    break
-                else:
-                    used = False
-            if not used:
-                break
+        msg.cookie = Cookie.allocate()
 
-        msg.cookie = cookie
-        
+        hops = []
         for i in reversed(range(len(path))):
             if i == 0:
                 msg.in_port = event.port
-                msg.data = event.ofp
             else:
                 msg.in_port = bucket.matrix_adj[path[i]][path[i-1]].interface
 
@@ -184,7 +260,7 @@ class Forwarding(object):
                 msg.actions = [of.ofp_action_output(port = bucket.matrix_adj[path[i]][path[i+1]].interface)]
                 msg_outport = bucket.matrix_adj[path[i]][path[i+1]].interface
 
-            core.openflow.sendToDPID(path[i], msg)
+            hops.insert(0, (path[i], msg.actions))
             bucket.flow_entry[path[i]][msg.cookie] = FlowEntry(msg.match.nw_src,\
                                                                msg.match.nw_dst,\
                                                                msg.match.nw_proto,\
@@ -192,4 +268,458 @@ class Forwarding(object):
                                                                msg.match.tp_dst,\
                                                                msg.in_port,\
                                                                msg_outport,\
-                                                               path)
\ No newline at end of file
+                                                               path)
+
+        cls._record_flow(msg, path, key, hops)
+        cls._install(event, key, msg, hops)
+
+class FlowInstaller(object):
+    """
+    Installs a flow along its path. The match is packed once for every hop,
+    the messages of each switch are written together, and barriers confirm
+    each hop. The ingress hop, which releases the packet, is only installed
+    once every downstream hop has confirmed. Errors are reported per hop.
+    """
+
+    queue = {}     # dpid -> packed messages waiting for the next flush
+    barrier = {}   # barrier xid -> (setup, dpid)
+    flow_mod = {}  # flow-mod xid -> (setup, dpid)
+    active = set()
+    counter = {'started': 0, 'done': 0, 'failed': 0}
+
+    @classmethod
+    def install(cls, msg, hops, data = None, callback = None, ordered = False):
+        # hops are (dpid, actions) from the ingress to the egress switch;
+        # ordered installs them one at a time from the egress, so the rules
+        # in place always lead to the destination
+        setup = FlowSetup(msg, hops, data, callback)
+        setup.raw_match = msg.match.pack(flow_mod=True)
+        cls.active.add(setup)
+        cls.counter['started'] += 1
+        if len(hops) == 1:
+            cls._install_ingress(setup)
+            return setup
+        if ordered:
+            setup.downstream = list(hops[1:])
+            cls._install_next(setup)
+            return setup
+        for dpid, actions in hops[1:]:
+            cls._queue_flow_mod(setup, dpid, actions)
+        for dpid in set(dpid for dpid, actions in hops[1:]):
+            cls._queue_barrier(setup, dpid)
+        return setup
+
+    @classmethod
+    def _install_next(cls, setup):
+        dpid, actions = setup.downstream.pop()
+        cls._queue_flow_mod(setup, dpid, actions)
+        cls._queue_barrier(setup, dpid)
+
+    @classmethod
+    def _install_ingress(cls, setup):
+        # a packet buffered by the switch is released by the flow-mod itself,
+        # otherwise its data goes back in a packet-out after the barrier
+        dpid, actions = setup.hops[0]
+        buffer_id = None
+        if setup.data is not None:
+            buffer_id = setup.data.buffer_id
+        if buffer_id is None:
+            cls._queue_flow_mod(setup, dpid, actions)
+        else:
+            cls._queue_flow_mod(setup, dpid, actions, buffer_id)
+        cls._queue_barrier(setup, dpid)
+        if setup.data is not None and buffer_id is None:
+            if setup.data.is_complete:
+                po = of.ofp_packet_out(data = setup.data)
+                po.actions = actions
+                cls._queue(dpid, po.pack())
+            else:
+                print('packet-in at %s truncated and not buffered, dropped' % dpid)
+        setup.ingress = True
+
+    @classmethod
+    def _queue_flow_mod(cls, setup, dpid, actions, buffer_id = of.NO_BUFFER):
+        xid = of.generate_xid()
+        cls.flow_mod[xid] = (setup, dpid)
+        setup.xids.append(xid)
+        packed_actions = b''.join(act.pack() for act in actions)
+        cls._queue(dpid, struct.pack('!BBHL', of.OFP_VERSION, of.OFPT_FLOW_MOD,
+                                     72 + len(packed_actions), xid) +
+                         setup.raw_match +
+                         struct.pack('!QHHHHLHH', setup.cookie, of.OFPFC_ADD,
+                                     setup.idle_timeout, setup.hard_timeout,
+                                     setup.priority, buffer_id,
+                                     of.OFPP_NONE, 0) +
+                         packed_actions)
+
+    @classmethod
+    def _queue_barrier(cls, setup, dpid):
+        msg = of.ofp_barrier_request()
+        cls.barrier[msg.xid] = (setup, dpid)
+        setup.waiting.add(msg.xid)
+        cls._queue(dpid, msg.pack())
+
+    @classmethod
+    def _queue(cls, dpid, raw):
+        if not cls.queue:
+            core.callLater(cls.flush)
+        cls.queue.setdefault(dpid, []).append(raw)
+
+    @classmethod
+    def flush(cls):
+        start = time.time()
+        queue, cls.queue = cls.queue, {}
+        for dpid in queue:
+            core.openflow.sendToDPID(dpid, b''.join(queue[dpid]))
+        Latency.add('flow-mod emission', time.time() - start)
+
+    @classmethod
+    def _handle_barrier(cls, event):
+        entry = cls.barrier.pop(event.ofp.xid, None)
+        if entry is None:
+            return
+        setup, dpid = entry
+        setup.waiting.discard(event.ofp.xid)
+        if setup.waiting:
+            return
+        if setup.ingress or setup.error:
+            cls._finish(setup)
+        elif setup.downstream:
+            cls._install_next(setup)
+        else:
+            cls._install_ingress(setup)
+
+    @classmethod
+    def _handle_error(cls, event):
+        entry = cls.flow_mod.get(event.ofp.xid)
+        if entry is None:
+            return
+        setup, dpid = entry
+        setup.error.append((dpid, event.ofp.type, event.ofp.code))
+
+    @classmethod
+    def _finish(cls, setup):
+        cls.active.discard(setup)
+        for xid in setup.xids:
+            cls.flow_mod.pop(xid, None)
+        for xid in setup.waiting:
+            cls.barrier.pop(xid, None)
+        setup.duration = time.time() - setup.start
+        if setup.error:
+            cls.counter['failed'] += 1
+            print('flow setup %s failed: %s' % (setup.match, setup.error))
+        else:
+            cls.counter['done'] += 1
+            Latency.add('flow setup', setup.duration)
+        if setup.callback is not None:
+            setup.callback(setup)
+
+    @classmethod
+    def expire(cls):
+        now = time.time()
+        for setup in list(cls.active):
+            if now - setup.start > config.INSTALL_TIMEOUT:
+                setup.error.append((None, 'timeout', None))
+                cls._finish(setup)
+
+class Timeouts(object):
+    """
+    Picks the timeouts of reactive rules from the rate of their flow, so
+    long heavy flows are no longer torn down and set up again at every hard
+    timeout while mice go away sooner.
+    """
+
+    history = OrderedDict() # flow key -> mean bps of the last flow with the key
+    history_size = 10000
+
+    @classmethod
+    def policy(cls, rate):
+        timeouts = None
+        for min_rate, idle, hard in config.TIMEOUT_POLICY:
+            if rate >= min_rate:
+                timeouts = (idle, hard)
+        return timeouts
+
+    @classmethod
+    def apply(cls, msg, key):
+        if not config.ADAPTIVE_TIMEOUT:
+            return
+        timeouts = cls.policy(cls.history.get(key, 0.))
+        if timeouts is not None:
+            msg.idle_timeout, msg.hard_timeout = timeouts
+
+    @classmethod
+    def remember(cls, record):
+        if record.key is None or not record.samples:
+            return
+        cls.history.pop(record.key, None)
+        cls.history[record.key] = record.rate()
+        while len(cls.history) > cls.history_size:
+            cls.history.popitem(last = False)
+
+    @classmethod
+    def refresh(cls):
+        if not config.ADAPTIVE_TIMEOUT:
+            return
+        for record in list(bucket.flows.values()):
+            if record.timeouts is None or \
+               len(record.samples) < record.samples.maxlen:
+                continue
+            timeouts = cls.policy(record.rate())
+            if timeouts is not None and timeouts != record.timeouts:
+                cls.reinstall(record, timeouts)
+
+    @classmethod
+    def reinstall(cls, record, timeouts):
+        # OpenFlow 1.0 keeps the timeouts of a modified rule, so the rule is
+        # added again; this replaces it and restarts its counters
+        for dpid in record.actions:
+            msg = of.ofp_flow_mod()
+            msg.command = of.OFPFC_ADD
+            msg.match = record.match
+            msg.cookie = record.cookie
+            msg.priority = record.priority
+            msg.idle_timeout, msg.hard_timeout = timeouts
+            msg.actions = record.actions[dpid]
+            core.openflow.sendToDPID(dpid, msg)
+        record.timeouts = timeouts
+
+class Rebalancer(object):
+    """
+    Moves heavy flows onto clearly wider paths without dropping packets:
+    the new path is installed hop by hop from the egress under a new
+    cookie, so a switch shared with the old path only redirects traffic
+    onto hops already in place. The ingress rule then replaces the old one,
+    and only afterwards are the old rules left on switches off the new path
+    deleted.
+    """
+
+    @classmethod
+    def rebalance(cls):
+        if not config.REBALANCE or config.LOCAL_ROUTING not in ('DFS', 'KSP'):
+            return
+        elephants = [record for record in bucket.flows.values()
+                     if len(record.path) > 1 and
+                     len(record.samples) == record.samples.maxlen and
+                     record.rate() >= config.ELEPHANT_RATE]
+        elephants.sort(key=lambda record: -record.rate())
+        moved = 0
+        for record in elephants:
+            if moved >= config.REBALANCE_MAX:
+                break
+            path = cls.better_path(record)
+            if path is not None:
+                cls.reroute(record, path)
+                moved += 1
+
+    @classmethod
+    def better_path(cls, record):
+        src, dst = record.path[0], record.path[-1]
+        rate = record.rate() / 10.**6
+        # the flow's own traffic is freed on its current path once moved
+        width = None
+        for i in range(len(record.path)-1):
+            link = bucket.matrix_adj.get(record.path[i], {}).get(record.path[i+1])
+            if link is None:
+                return None
+            if width is None or link.residual_capacity() < width:
+                width = link.residual_capacity()
+        width += rate
+        current = tuple(record.path[1:])
+        for way, metric in routing.DFS.getRanked_SNH(src, dst):
+            if tuple(way.path) == current:
+                continue
+            if metric >= rate and metric > width * config.REBALANCE_GAIN:
+                return [src] + list(way.path)
+            return None
+        return None
+
+    @classmethod
+    def reroute(cls, record, path):
+        old = record.hops[path[0]] # sampled flows always have their ingress
+        egress = record.actions[record.path[-1]]
+        # rewrites done on the way (not the output) are kept on every hop
+        rewrite = [act for act in record.actions[record.path[0]]
+                   if not isinstance(act, of.ofp_action_output)]
+
+        msg = of.ofp_flow_mod()
+        msg.match = record.match
+        msg.priority = record.priority
+        msg.idle_timeout, msg.hard_timeout = record.timeouts
+        msg.cookie = Cookie.allocate()
+
+        hops = []
+        new = FlowRecord(msg.cookie, record.match, record.priority, path,
+                         record.key)
+        new.timeouts = record.timeouts
+        for i in range(len(path)):
+            if i == len(path)-1:
+                actions = egress
+            else:
+                actions = rewrite + [of.ofp_action_output(port = bucket.matrix_adj[path[i]][path[i+1]].interface)]
+            if i == 0:
+                in_port = record.hops[path[0]].in_port
+            else:
+                in_port = bucket.matrix_adj[path[i]][path[i-1]].interface
+            hops.append((path[i], actions))
+            new.actions[path[i]] = actions
+            new.hops[path[i]] = FlowEntry(old.nw_src, old.nw_dst, old.nw_proto,
+                                          old.tp_src, old.tp_dst, in_port,
+                                          actions[-1].port, path,
+                                          dpid = old.initial_dpid)
+            bucket.flow_entry.setdefault(path[i], {})[msg.cookie] = new.hops[path[i]]
+        bucket.flows[msg.cookie] = new
+
+        old_hops = dict(record.hops)
+
+        def done(setup):
+            if setup.error:
+                cls.revert(record, old_hops, new)
+                return
+            # rules on switches of both paths were replaced by the new ones
+            bucket.flows.pop(record.cookie, None)
+            for dpid in record.actions:
+                bucket.flow_entry.get(dpid, {}).pop(record.cookie, None)
+                if dpid in new.actions:
+                    continue
+                delete = of.ofp_flow_mod()
+                delete.command = of.OFPFC_DELETE_STRICT
+                delete.priority = record.priority
+                delete.match = record.match
+                core.openflow.sendToDPID(dpid, delete)
+            print('flow %s moved to %s' % (record, path))
+        FlowInstaller.install(msg, hops, None, done, ordered = True)
+
+    @classmethod
+    def revert(cls, record, old_hops, new):
+        # the ingress keeps its old rule; new rules go from the switches off
+        # the old path, shared switches get the old rule back
+        bucket.flows.pop(new.cookie, None)
+        for dpid in new.actions:
+            bucket.flow_entry.get(dpid, {}).pop(new.cookie, None)
+            if dpid == record.path[0]:
+                continue
+            msg = of.ofp_flow_mod()
+            msg.match = record.match
+            msg.priority = record.priority
+            if dpid in record.actions:
+                msg.command = of.OFPFC_ADD
+                msg.cookie = record.cookie
+                msg.idle_timeout, msg.hard_timeout = record.timeouts
+                msg.actions = record.actions[dpid]
+                if dpid in old_hops:
+                    record.hops[dpid] = old_hops[dpid]
+                    bucket.flow_entry.setdefault(dpid, {})[record.cookie] = old_hops[dpid]
+            else:
+                msg.command = of.OFPFC_DELETE_STRICT
+            core.openflow.sendToDPID(dpid, msg)
+        bucket.flows[record.cookie] = record
+        print('flow %s not moved to %s' % (record, new.path))
+
+class Proactive(object):
+    """
+    Pre-installs a per-destination rule towards each learned host on every
+    switch. The rules follow a tree made of the current best paths, so the
+    first packet of a conversation is forwarded by the switches alone.
+    Reactive rules keep a higher priority.
+    """
+
+    tree = {}         # host ip -> {dpid: out port}
+    cookie = {}       # (host ip, dpid) -> cookie of the rule
+    scheduled = False
+
+    @classmethod
+    def build_tree(cls, ip):
+        host = bucket.arp_table[ip]
+        tree = {host.dpid: host.port}
+        for dpid in bucket.matrix_adj:
+            if dpid in tree:
+                continue
+            try:
+                path = [dpid] + Forwarding.getPath(dpid, host.dpid)
+            except Exception:
+                continue
+            # walk until the path joins the tree, so the tree stays loop-free
+            for i in range(len(path)-1):
+                if path[i] in tree:
+                    break
+                tree[path[i]] = bucket.matrix_adj[path[i]][path[i+1]].interface
+        return tree
+
+    @classmethod
+    def refresh(cls, ip):
+        if ip not in bucket.arp_table:
+            cls.forget(ip)
+            return
+        host = bucket.arp_table[ip]
+        old = cls.tree.get(ip, {})
+        new = cls.build_tree(ip)
+        for dpid in new:
+            if old.get(dpid) == new[dpid]:
+                continue
+            msg = of.ofp_flow_mod()
+            msg.priority = config.PROACTIVE_PRIORITY
+            msg.match = cls.match(ip)
+            msg.cookie = Cookie.allocate()
+            actions = []
+            if dpid == host.dpid:
+                actions.append(of.ofp_action_dl_addr.set_dst(host.mac_addr))
+            actions.append(of.ofp_action_output(port = new[dpid]))
+            # the rule replaces the previous one on the switch, its bytes
+            # count in the load of its port like those of reactive rules
+            cls.forget_cookie(ip, dpid)
+            cls.cookie[(ip, dpid)] = msg.cookie
+            bucket.flow_entry.setdefault(dpid, {})[msg.cookie] = \
+                FlowEntry(None, ip, None, None, None, None, new[dpid], [dpid],
+                          dpid = dpid)
+            FlowInstaller.install(msg, [(dpid, actions)])
+        for dpid in old:
+            if dpid not in new:
+                cls.delete(ip, dpid)
+        cls.tree[ip] = new
+
+    @classmethod
+    def refresh_all(cls):
+        cls.scheduled = False
+        for ip in list(bucket.arp_table):
+            cls.refresh(ip)
+
+    @classmethod
+    def schedule(cls):
+        # topology events come in bursts, refresh once after them
+        if not cls.scheduled:
+            cls.scheduled = True
+            core.callLater(cls.refresh_all)
+
+    @classmethod
+    def forget(cls, ip):
+        for dpid in cls.tree.pop(ip, {}):
+            cls.delete(ip, dpid)
+
+    @classmethod
+    def forget_switch(cls, dpid):
+        for ip in cls.tree:
+            cls.tree[ip].pop(dpid, None)
+            cls.forget_cookie(ip, dpid)
+
+    @classmethod
+    def forget_cookie(cls, ip, dpid):
+        cookie = cls.cookie.pop((ip, dpid), None)
+        if cookie is not None:
+            bucket.flow_entry.get(dpid, {}).pop(cookie, None)
+
+    @classmethod
+    def delete(cls, ip, dpid):
+        cls.forget_cookie(ip, dpid)
+        msg = of.ofp_flow_mod()
+        msg.command = of.OFPFC_DELETE_STRICT
+        msg.priority = config.PROACTIVE_PRIORITY
+        msg.match = cls.match(ip)
+        core.openflow.sendToDPID(dpid, msg)
+
+    @classmethod
+    def match(cls, ip):
+        match = of.ofp_match()
+        match.dl_type = pkt.ethernet.IP_TYPE
+        match.nw_dst = ip
+        return match
@@ -25,6 +25,13 @@ This component stores libraries for the application.
 """
 
 from __future__ import print_function
+import bisect
+import random
+from array import array
+import time
+from collections import deque
+
+from config import config
 from bucket import bucket
 
 def curr_to_capacity(curr):
@@ -40,6 +47,10 @@ def curr_to_capacity(curr):
     # return capacity[127 & curr]
     return 100. # for TC in mininet
 
+def ewma(previous, sample):
+    # smoothed rate, RATE_ALPHA is the weight of the new sample
+    return config.RATE_ALPHA * sample + (1 - config.RATE_ALPHA) * previous
+
 class PortDetail(object):
     def __init__(self, index, name, port_no, state, capacity):
         self.index = index
@@ -48,6 +59,8 @@ class PortDetail(object):
         self.state = state
         self.capacity = capacity
         self.upload = 0
+        self.tx_bytes = None # last counter seen in port stats
+        self.stamp = None    # time it was seen
         self.__name__ = name
 
     def set_load(self, load = 0):
@@ -62,14 +75,21 @@ class LinkDetail(object):
         self.dpid = dpid
         self.capacity = capacity
         self.interface = interface
-        # self.update_load()
+        self.load = 0.
+        self.metric = self.calc_metric()
 
     def update_load(self):
-        self.load = bucket.port_info[self.dpid][self.interface].upload
-        # self.metric = self.calc_metric()
-        # print(self.__repr__())
+        # returns whether the load has changed
+        load = bucket.port_info[self.dpid][self.interface].upload
+        if load == self.load:
+            return False
+        self.load = load
+        self.metric = self.calc_metric()
+        return True
 
     def calc_metric(self):
+        if self.capacity <= self.load:
+            return float('inf')
         return 10**2/(self.capacity-self.load)
 
     def residual_capacity(self):
@@ -80,6 +100,33 @@ class LinkDetail(object):
                                                          self.load,
                                                          self.metric)
 
+class GatewayDetail(object):
+    def __init__(self, dpid, port_no, ip_addr, next_hop):
+        self.dpid = dpid
+        self.port_no = port_no
+        self.ip_addr = ip_addr
+        self.next_hop = next_hop
+        self.available = True
+        self.load = 0.
+
+    def update_load(self):
+        # returns whether the load has changed
+        load = bucket.port_info[self.dpid][self.port_no].upload
+        if load == self.load:
+            return False
+        self.load = load
+        return True
+
+    def residual_capacity(self):
+        port = bucket.port_info.get(self.dpid, {}).get(self.port_no)
+        if port is None:
+            return 0.
+        return port.capacity - self.load
+
+    def __repr__(self):
+        return "%s:%s via %s (%s)" % (self.dpid, self.port_no, self.next_hop,
+                                      'up' if self.available else 'down')
+
 class ARPDets(object):
     def __init__(self, dpid, port, mac_addr, time = 0):
         self.dpid = dpid
@@ -87,11 +134,27 @@ class ARPDets(object):
         self.mac_addr = mac_addr
         # self.time = time
 
+def intern_path(path):
+    # equal hop sequences share one tuple
+    path = tuple(path)
+    return bucket.path_pool.setdefault(path, path)
+
 class OneWayPath(object):
+    __slots__ = ('path', 'source', 'metric', 'metric_epoch', 'metric_SNH',
+                 'metric_SNH_epoch')
+
     def __init__(self, path, source):
-        self.path = path
+        self.path = intern_path(path)
         self.source = source
-        # self.metric = self.calc_metric()
+        # metrics are cached until bucket.load_epoch moves
+        self.metric_epoch = None
+        self.metric_SNH_epoch = None
+
+    def links(self):
+        prev = self.source
+        for i in self.path:
+            yield prev, i
+            prev = i
 
     def calc_metric(self):
         temp_metric = 0
@@ -103,7 +166,10 @@ class OneWayPath(object):
         return temp_metric  
 
     def get_metric(self):
-        return self.calc_metric()
+        if self.metric_epoch != bucket.load_epoch:
+            self.metric = self.calc_metric()
+            self.metric_epoch = bucket.load_epoch
+        return self.metric
 
     def calc_metric_SNH(self):
         temp_metric = 0
@@ -118,7 +184,65 @@ class OneWayPath(object):
         return temp_metric 
 
     def get_metric_SNH(self):
-        return self.calc_metric_SNH()
+        if self.metric_SNH_epoch != bucket.load_epoch:
+            self.metric_SNH = self.calc_metric_SNH()
+            self.metric_SNH_epoch = bucket.load_epoch
+        return self.metric_SNH
+
+class Cookie(object):
+    # the upper 16 bits tell controller instances apart, the lower 48 bits
+    # count the flows of this instance, so cookies never collide
+    prefix = None
+    counter = 0
+
+    @classmethod
+    def allocate(cls):
+        if cls.prefix is None:
+            if config.COOKIE_PREFIX is None:
+                cls.prefix = random.randint(1, 0xfffe) # all 1s is reserved
+            else:
+                cls.prefix = config.COOKIE_PREFIX & 0xffff
+        cls.counter = cls.counter % 0xffffffffffff + 1
+        return (cls.prefix << 48) | cls.counter
+
+class FlowRecord(object):
+    def __init__(self, cookie, match, priority, path, key = None):
+        self.cookie = cookie
+        self.match = match
+        self.priority = priority
+        self.path = path
+        self.key = key
+        self.hops = {}    # dpid -> FlowEntry
+        self.actions = {} # dpid -> actions of the rule
+        self.timeouts = None
+        self.samples = deque(maxlen = config.TIMEOUT_SAMPLES) # ingress bps
+
+    def rate(self):
+        if not self.samples:
+            return 0.
+        return sum(self.samples) / len(self.samples)
+
+    def __repr__(self):
+        return "%x %s |%s|" % (self.cookie, self.match, self.path)
+
+class FlowSetup(object):
+    def __init__(self, msg, hops, data = None, callback = None):
+        self.match = msg.match
+        self.cookie = msg.cookie
+        self.priority = msg.priority
+        self.idle_timeout = msg.idle_timeout
+        self.hard_timeout = msg.hard_timeout
+        self.hops = hops
+        self.data = data
+        self.callback = callback
+        self.start = time.time()
+        self.duration = None
+        self.ingress = False
+        self.waiting = set()  # barrier xids not answered yet
+        self.xids = []        # flow-mod xids
+        self.error = []
+        self.held = []        # packet-ins of the flow waiting for the setup
+        self.downstream = []  # hops left to install one by one, egress last
 
 class FlowEntry(object):
     def __init__(self, nw_src, nw_dst, nw_proto, tp_src, tp_dst, in_port, out_port, path = [], **opts):
@@ -132,12 +256,137 @@ class FlowEntry(object):
         self.path = path
         if 'dpid' in opts:
             self.initial_dpid = opts['dpid']
+        elif nw_src is None:
+            # per-destination rule, the flow is known from its ingress only
+            self.initial_dpid = path[0]
         else:
             self.initial_dpid = bucket.arp_table[nw_src].dpid
         self.bps = 0.
         self.byte_count = 0.
+        self.duration = None # age of the rule when byte_count was seen
+        self.created = time.time()
 
     def __repr__(self):
         return "%s:%s >%s> %s:%s |%s| %s Mbps" % (self.nw_src, self.tp_src,\
                                                self.nw_proto, self.nw_dst, \
                                                self.tp_dst, self.path, self.bps/10.**6)
+
+class Histogram(object):
+    # upper bound of each bucket in seconds, the last bucket has none
+    bounds = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02,
+              0.05, 0.1, 0.2, 0.5, 1., 2., 5.)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        rank = p / 100. * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return 0.
+
+    def mean(self):
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def __repr__(self):
+        return "%s n, mean %.3f ms, p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms" % \
+               (self.count, self.mean()*1000., self.percentile(50)*1000.,
+                self.percentile(90)*1000., self.percentile(99)*1000.,
+                self.max*1000.)
+
+class Latency(object):
+    """
+    Latency histograms of the controller, one per measured step: packet-in
+    handling by kind (arp, dhcp, internal, external), path lookup, flow-mod
+    emission and the barrier-confirmed flow setup.
+    """
+
+    @classmethod
+    def add(cls, name, seconds):
+        if config.LATENCY_STATS:
+            if name not in bucket.latency:
+                bucket.latency[name] = Histogram()
+            bucket.latency[name].add(seconds)
+
+    @classmethod
+    def dump(cls, filename):
+        # one line per bucket: name, upper bound in seconds, count
+        with open(filename, 'w') as f:
+            for name in sorted(bucket.latency):
+                histogram = bucket.latency[name]
+                bounds = list(map(repr, histogram.bounds)) + ['inf']
+                for bound, n in zip(bounds, histogram.buckets):
+                    f.write('%s %s %s\n' % (name, bound, n))
+
+class Ring(object):
+    # fixed ring of per-step mean and peak values, the step being filled is
+    # aggregated apart and written once the time moves past it
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.mean = array('d', [float('nan')] * size)
+        self.peak = array('d', [float('nan')] * size)
+        self.slot = None
+        self.total = 0.
+        self.count = 0
+        self.max = 0.
+
+    def add(self, t, value):
+        slot = int(t // self.step)
+        if self.slot is None:
+            self.slot = slot
+        elif slot > self.slot:
+            self.close(slot)
+        self.total += value
+        self.count += 1
+        if self.count == 1 or value > self.max:
+            self.max = value
+
+    def close(self, slot):
+        i = self.slot % self.size
+        self.mean[i] = self.total / self.count
+        self.peak[i] = self.max
+        # steps without samples are left empty
+        for empty in range(self.slot + 1, min(slot, self.slot + 1 + self.size)):
+            self.mean[empty % self.size] = float('nan')
+            self.peak[empty % self.size] = float('nan')
+        self.slot = slot
+        self.total = 0.
+        self.count = 0
+
+    def series(self):
+        # (start time, mean, peak) of the stored steps, oldest first
+        if self.slot is None:
+            return []
+        result = []
+        for slot in range(self.slot - self.size, self.slot):
+            i = slot % self.size
+            if self.mean[i] == self.mean[i]: # not nan
+                result.append((slot * self.step, self.mean[i], self.peak[i]))
+        return result
+
+class TimeSeries(object):
+    def __init__(self, resolutions):
+        self.rings = [Ring(step, size) for step, size in resolutions]
+
+    def add(self, t, value):
+        for ring in self.rings:
+            ring.add(t, value)
@@ -27,13 +27,15 @@ and coordinate each event to other sub-component.
 from __future__ import print_function
 import time
 import thread
+import multiprocessing
 
 from config import config
 from bucket import bucket
 from lib import *
 import routing
-from forwarding import Forwarding
+from forwarding import Forwarding, FlowInstaller, Proactive, Timeouts, Rebalancer
 import misc
+from monitor import Poller, History
 import cli
 
 from pox.core import core
@@ -49,20 +51,130 @@ class main(EventMixin):
         core.listen_to_dependencies(self, listen_args={'openflow': {'priority':0}})
 
         if config.USE_STATIC_GATEWAY:
-            bucket.gateway = config.STATIC_GATEWAY
-
+            for dpid in config.STATIC_GATEWAY:
+                gateway = config.STATIC_GATEWAY[dpid]
+                bucket.gateway[dpid] = GatewayDetail(dpid, gateway['port_no'],
+                                                     IPAddr(gateway['ip_addr']),
+                                                     IPAddr(gateway['next_hop']))
+
+        # paths follow the topology events, the periodic full recompute
+        # only runs when an incremental update has failed
+        self._path_outdated = False
+        self._routing_pool = None
+        self._routing_busy = False
+        self._routing_started = None
         Timer(10, self._routing, recurring=True)
-        Timer(1, self._send_FlowStatsReq, recurring=True)
-
-    def _routing(self):
+        Timer(Poller.tick, Poller.poll, recurring=True)
+        Timer(1, History.sample, recurring=True)
+        Timer(1, FlowInstaller.expire, recurring=True)
+        Timer(1, Timeouts.refresh, recurring=True)
+        Timer(config.REBALANCE_INTERVAL, Rebalancer.rebalance, recurring=True)
+        Timer(config.PROACTIVE_REFRESH, self._refresh_proactive, recurring=True)
+
+    def _routing_engine(self):
         if config.LOCAL_ROUTING == 'DFS':
-            bucket.path_list = routing.DFS.findAllPairsPath(bucket.matrix_adj)
+            return routing.DFS
+        elif config.LOCAL_ROUTING == 'KSP':
+            return routing.KSP
         elif config.LOCAL_ROUTING == 'Djisktra':
-            pass
+            return None # paths are searched on demand, nothing to precompute
+
+    def _routing(self):
+        if not self._path_outdated:
+            return
+        engine = self._routing_engine()
+        if engine is None:
+            self._path_outdated = False
+        elif config.ROUTING_WORKERS > 0:
+            self._routing_async()
+        else:
+            bucket.path_pool = {}
+            bucket.path_list = engine.findAllPairsPath(bucket.matrix_adj)
+            routing.PathIndex.rebuild(bucket.path_list)
+            self._path_outdated = False
+            if config.PROACTIVE:
+                Proactive.schedule()
+
+    def _routing_async(self):
+        # the worker pool computes a snapshot of the topology, one task per
+        # source switch, while the current path_list keeps serving lookups
+        if self._routing_busy:
+            if time.time() - self._routing_started < config.ROUTING_TIMEOUT:
+                return
+            # a dead worker never calls back, the job is lost with its pool
+            print('routing job lost, restarting the worker pool')
+            self._routing_pool.terminate()
+            self._routing_pool = None
+            self._routing_busy = False
+        if self._routing_pool is None:
+            self._routing_pool = multiprocessing.Pool(config.ROUTING_WORKERS)
+        self._routing_busy = True
+        self._routing_started = started = time.time()
+        version = bucket.topology_version
+        matrix = dict((i, list(bucket.matrix_adj[i])) for i in bucket.matrix_adj)
+        tasks = [(config.LOCAL_ROUTING, matrix, i, config.KSP_K, config.KSP_MAX_HOP)
+                 for i in matrix]
+
+        def done(result):
+            core.callLater(self._swap_path, version, result, started)
+
+        self._routing_pool.map_async(routing.findOneSourceWay, tasks,
+                                     callback=done)
+
+    def _swap_path(self, version, result, started):
+        if started != self._routing_started:
+            return # from a job given up on
+        self._routing_busy = False
+        if version != bucket.topology_version:
+            self._routing() # topology moved on, the result is stale
+            return
+        if any(ways is None for origin, ways in result):
+            return # stays outdated, retried by the timer
+
+        engine = self._routing_engine()
+        bucket.path_pool = {}
+        path_list = {}
+        for origin, ways in result:
+            path_list[origin] = engine.toPath(origin, ways)
+        bucket.path_list = path_list
+        routing.PathIndex.rebuild(path_list)
+        self._path_outdated = False
+        if config.PROACTIVE:
+            Proactive.schedule()
+
+    def _update_path(self, method, *args):
+        bucket.topology_version += 1
+        if config.PROACTIVE:
+            # runs after this event, once the paths follow the change
+            Proactive.schedule()
+        engine = self._routing_engine()
+        if engine is None:
+            return
+        if method == 'addLink' and \
+           (self._path_outdated or config.ROUTING_WORKERS > 0):
+            # removals always apply to the table being served, new paths
+            # wait for the full recompute
+            self._path_outdated = True
+            if config.ROUTING_WORKERS > 0:
+                self._routing()
+            return
+        try:
+            getattr(engine, method)(bucket.matrix_adj, bucket.path_list, *args)
+        except Exception as e:
+            print('incremental routing failed (%s), recompute later' % e)
+            self._path_outdated = True
 
-    def _send_FlowStatsReq(self):
-        for connection in core.openflow._connections:
-            connection.send(of.ofp_stats_request(body=of.ofp_flow_stats_request()))
+    def _host_learned(self, ip):
+        if config.PROACTIVE:
+            Proactive.refresh(ip)
+
+    def _host_released(self, ip):
+        Proactive.forget(ip)
+
+    def _refresh_proactive(self):
+        # also follows path choices which moved with the link loads
+        if config.PROACTIVE:
+            Proactive.refresh_all()
 
     def _periodic_report(self):
         pass
@@ -74,6 +186,8 @@ class main(EventMixin):
             bucket.matrix_adj[event.dpid] = {}
             bucket.port_info[event.dpid] = {}
             bucket.flow_entry[event.dpid] = {}
+        bucket.path_list.setdefault(event.dpid, {})
+        Poller.add(event.dpid)
 
         for i,v in enumerate(event.ofp.ports):
             if (v.port_no < 60000):
@@ -82,6 +196,9 @@ class main(EventMixin):
                                                                      v.state,
                                                                      curr_to_capacity(v.curr))
 
+        if config.MISS_SEND_LEN is not None:
+            event.connection.send(of.ofp_set_config(miss_send_len = config.MISS_SEND_LEN))
+
         if config.USE_DHCP:
             msg = of.ofp_flow_mod()
             msg.match = of.ofp_match()
@@ -95,6 +212,8 @@ class main(EventMixin):
 
     def _handle_openflow_ConnectionDown(self, event):
         print('DPID %s is DOWN' % (event.dpid))
+        Proactive.forget_switch(event.dpid)
+        Poller.remove(event.dpid)
 
         if event.dpid in bucket.matrix_adj:
             del bucket.matrix_adj[event.dpid]
@@ -104,30 +223,28 @@ class main(EventMixin):
 
         if event.dpid in bucket.port_info:
             del bucket.port_info[event.dpid]
-        if event.dpid in bucket.path_list:
-            del bucket.path_list[event.dpid]
-        for i in bucket.path_list:
-            if event.dpid in bucket.path_list[i]:
-                del bucket.path_list[i][event.dpid]
-            for j in bucket.path_list[i]:
-                temp = []
-                for k in bucket.path_list[i][j]:
-                    if event.dpid in k.path:
-                        temp.append(k)
-                bucket.path_list[i][j] = list(set(bucket.path_list[i][j]) - set(temp))
+        self._update_path('removeSwitch', event.dpid)
 
     def _handle_openflow_discovery_LinkEvent(self, event):
+        dpid1 = event.link.dpid1
+        dpid2 = event.link.dpid2
+        port1 = event.link.port1
+        port2 = event.link.port2
         if event.added:
-            dpid1 = event.link.dpid1
-            dpid2 = event.link.dpid2
-            port1 = event.link.port1
-            port2 = event.link.port2
             capacity = min(bucket.port_info[dpid1][port1].capacity,
                            bucket.port_info[dpid2][port2].capacity)
-            bucket.matrix_adj[dpid1][dpid2] = LinkDetail(dpid1, capacity, port1)
-            bucket.matrix_adj[dpid2][dpid1] = LinkDetail(dpid2, capacity, port2)
+            bucket.load_epoch += 1
+            if dpid2 not in bucket.matrix_adj[dpid1]:
+                bucket.matrix_adj[dpid1][dpid2] = LinkDetail(dpid1, capacity, port1)
+                self._update_path('addLink', dpid1, dpid2)
+            if dpid1 not in bucket.matrix_adj[dpid2]:
+                bucket.matrix_adj[dpid2][dpid1] = LinkDetail(dpid2, capacity, port2)
+                self._update_path('addLink', dpid2, dpid1)
         elif event.removed:
             print('link discovery timeout')
+            if dpid2 in bucket.matrix_adj.get(dpid1, {}):
+                del bucket.matrix_adj[dpid1][dpid2]
+                self._update_path('removeLink', dpid1, dpid2)
 
     def _handle_openflow_PortStatus(self, event):
         dpid = event.dpid
@@ -142,44 +259,22 @@ class main(EventMixin):
                 if dpid in bucket.gateway:
                     if event.ofp.desc.port_no == bucket.gateway[dpid].port_no:
                         bucket.gateway[dpid].available = False
-                        for cookie in bucket.flow_entry[dpid]:
-                                if bucket.flow_entry[dpid][cookie].out_port == port_no:
-                                   msg = of.ofp_flow_mod()
-                                   msg.cookie = cookie
-                                   msg.command = of.OFPFC_DELETE
-                                   core.openflow.sendToDPID(bucket.flow_entry[dpid][cookie].initial_dpid, msg)          
+                        bucket.gateway_epoch += 1
+                        self._delete_flow_by_port(dpid, port_no)
 
                 if dpid in bucket.matrix_adj:
-                    for dpid_next in bucket.matrix_adj[dpid]:
-                        if bucket.matrix_adj[dpid][dpid_next].interface == port_no:
-                            del bucket.matrix_adj[dpid][dpid_next]
+                    dpid_next = None
+                    for i in bucket.matrix_adj[dpid]:
+                        if bucket.matrix_adj[dpid][i].interface == port_no:
+                            dpid_next = i
                             break
 
-                    if 'dpid_next' not in locals():
+                    if dpid_next is None:
                         return
 
-                    for i in bucket.path_list:
-                        for j in bucket.path_list[i]:
-                            will_delete = []
-                            for k in range(len(bucket.path_list[i][j])):
-                                if bucket.path_list[i][j][k].path[0] == dpid_next and i == dpid:
-                                   will_delete.append(bucket.path_list[i][j][k])
-                                   continue
-                                for l in range(len(bucket.path_list[i][j][k].path)-1):
-                                    if (bucket.path_list[i][j][k].path[l] == dpid and \
-                                        bucket.path_list[i][j][k].path[l+1] == dpid_next):
-                                        will_delete.append(bucket.path_list[i][j][k])
-                                        break
-                            bucket.path_list[i][j] = list(set(bucket.path_list[i][j]) - set(will_delete))
-
-                    for cookie in bucket.flow_entry[dpid]:
-                        for j in range(len(bucket.flow_entry[dpid][cookie].path)-1):
-                            if bucket.flow_entry[dpid][cookie].path[j] == dpid and \
-                               bucket.flow_entry[dpid][cookie].path[j+1] == dpid_next:
-                               msg = of.ofp_flow_mod()
-                               msg.cookie = cookie
-                               msg.command = of.OFPFC_DELETE
-                               core.openflow.sendToDPID(bucket.flow_entry[dpid][cookie].initial_dpid, msg)                                        
+                    del bucket.matrix_adj[dpid][dpid_next]
+                    self._update_path('removeLink', dpid, dpid_next)
+                    self._delete_flow_by_port(dpid, port_no)
             else:
                 # state = 'up'
                 print('port [%s] at dpid[%s] is Up' % (port_no, dpid))
@@ -187,49 +282,129 @@ class main(EventMixin):
                 if dpid in bucket.gateway:
                     if event.ofp.desc.port_no == bucket.gateway[dpid].port_no:
                         bucket.gateway[dpid].available = True
-               
+                        bucket.gateway_epoch += 1
+                # the link itself comes back through discovery's LinkEvent
 
-                # belum selesai, masih mengandalahkan 10s _findPath(), belum realtime ketika hidup
+    def _delete_flow_by_port(self, dpid, port_no):
+        # every hop of the flows leaving through the port is deleted
+        for cookie in [cookie for cookie in bucket.flow_entry.get(dpid, {})
+                       if bucket.flow_entry[dpid][cookie].out_port == port_no]:
+            Forwarding.delete_flow(cookie)
 
     def _handle_openflow_FlowStatsReceived(self, event):
+        # one pass over the reply, each stat finds its entry by cookie and
+        # adds its rate to the load of its output ports
         dpid = event.dpid
-        will_delete = []
+        entries = bucket.flow_entry[dpid]
+        sent = Poller.sent(dpid, 'flow')
+        seen = set()
         temp = {}
-        for cookie in bucket.flow_entry[dpid]:
-            found = False
-            for flow_event in event.stats:
-                if (cookie == flow_event.cookie) and (flow_event.actions[-1].port == bucket.flow_entry[dpid][cookie].out_port):
-                    bucket.flow_entry[dpid][cookie].bps = (flow_event.byte_count - bucket.flow_entry[dpid][cookie].byte_count)*8
-                    bucket.flow_entry[dpid][cookie].byte_count = flow_event.byte_count
-
-                    for act in flow_event.actions:
-                        if isinstance(act, of.ofp_action_output):
-                            if act.port in temp:
-                                temp[act.port] += bucket.flow_entry[dpid][cookie].bps
-                            else:
-                                temp[act.port] = bucket.flow_entry[dpid][cookie].bps
-                    found = True
-                    break
-
-            if not found:
-                will_delete.append(cookie) # kalau cookie sudah tidak ada, aka flow has been removed
+        for flow_event in event.stats:
+            cookie = flow_event.cookie
+            entry = entries.get(cookie)
+            if entry is None or cookie in seen or not flow_event.actions or \
+               getattr(flow_event.actions[-1], 'port', None) != entry.out_port:
+                continue
+            seen.add(cookie)
+            # the age of the rule on the switch times the counters, however
+            # late the reply arrives
+            duration = flow_event.duration_sec + flow_event.duration_nsec/10.**9
+            if entry.duration is None or duration < entry.duration or \
+               flow_event.byte_count < entry.byte_count:
+                byte_count, elapsed = 0, duration # new or added again
+            else:
+                byte_count, elapsed = entry.byte_count, duration - entry.duration
+            if elapsed > 0:
+                bps = (flow_event.byte_count - byte_count)*8. / elapsed
+                if entry.duration is None:
+                    entry.bps = bps
+                else:
+                    entry.bps = ewma(entry.bps, bps)
+            entry.byte_count = flow_event.byte_count
+            entry.duration = duration
+            if cookie in bucket.flows and bucket.flows[cookie].path[0] == dpid:
+                bucket.flows[cookie].samples.append(entry.bps)
+
+            for act in flow_event.actions:
+                if isinstance(act, of.ofp_action_output):
+                    temp[act.port] = temp.get(act.port, 0.) + entry.bps
+
+        # kalau cookie sudah tidak ada, aka flow has been removed; rules
+        # still being installed or registered after the request went out
+        # can not be in the reply yet
+        installing = set(setup.cookie for setup in FlowInstaller.active)
+        will_delete = [cookie for cookie in entries if cookie not in seen and
+                       cookie not in installing and
+                       entries[cookie].created < sent]
 
         for i in will_delete:
             bucket.flow_entry[dpid].pop(i, None)
+            if i in bucket.flows:
+                bucket.flows[i].hops.pop(dpid, None)
+                if not bucket.flows[i].hops:
+                    Timeouts.remember(bucket.flows.pop(i))
+
+        if config.LOAD_MEASUREMENT == 'port':
+            Poller.replied(dpid, 'flow')
+            return # the port stats keep the load
 
         for output_port in bucket.port_info[dpid]:
             if output_port in temp:
                 bucket.port_info[dpid][output_port].set_load(temp[output_port]/10.**6)
             else:
                 bucket.port_info[dpid][output_port].set_load(0.)
+        self._update_load(dpid)
+        Poller.replied(dpid, 'flow')
 
+    def _handle_openflow_PortStatsReceived(self, event):
+        dpid = event.dpid
+        if config.LOAD_MEASUREMENT != 'port' or dpid not in bucket.port_info:
+            Poller.replied(dpid, 'port')
+            return
+        now = time.time()
+        for stat in event.stats:
+            port = bucket.port_info[dpid].get(stat.port_no)
+            if port is None:
+                continue
+            # port stats carry no time, the arrival of the reply is used
+            if port.tx_bytes is not None and stat.tx_bytes >= port.tx_bytes \
+               and now > port.stamp:
+                port.set_load(ewma(port.upload,
+                                   (stat.tx_bytes - port.tx_bytes)*8/10.**6 /
+                                   (now - port.stamp)))
+            port.tx_bytes = stat.tx_bytes
+            port.stamp = now
+        self._update_load(dpid)
+        Poller.replied(dpid, 'port')
+
+    def _update_load(self, dpid):
+        # links and gateway of the switch follow the load of their ports
+        changed = False
         for dest_switch in bucket.matrix_adj[dpid]:
-            bucket.matrix_adj[dpid][dest_switch].update_load()
+            if bucket.matrix_adj[dpid][dest_switch].update_load():
+                routing.PathRank.invalidateLink(dpid, dest_switch)
+                routing.VectorMetric.updateLink(dpid, dest_switch)
+                changed = True
+        if changed:
+            bucket.load_epoch += 1
 
         if dpid in bucket.gateway:
-            bucket.gateway[dpid].update_load()
+            if bucket.gateway[dpid].update_load():
+                bucket.gateway_epoch += 1
+
+    def _handle_openflow_BarrierIn(self, event):
+        FlowInstaller._handle_barrier(event)
+
+    def _handle_openflow_ErrorIn(self, event):
+        FlowInstaller._handle_error(event)
 
     def _handle_openflow_PacketIn(self, event):
+        start = time.time()
+        kind = self._dispatch_PacketIn(event)
+        if kind is not None:
+            Latency.add(kind, time.time() - start)
+
+    def _dispatch_PacketIn(self, event):
         data_frame = event.parsed
 
         if not data_frame.type or not data_frame.parsed:
@@ -242,7 +417,7 @@ class main(EventMixin):
         # check whether data is ARP packet
         if data_frame.type == pkt.ethernet.ARP_TYPE:
             misc.ARP._handle_arp(event)
-            return
+            return 'arp'
 
         data_packet = event.parsed.find('ipv4')
         if not data_packet or not data_packet.parsed:
@@ -256,14 +431,17 @@ class main(EventMixin):
             if data_segment.srcport == 68 and \
                data_segment.dstport == 67:
                 misc.DHCP._handle_dhcp(event)
+                return 'dhcp'
             return
 
         if data_packet.dstip.is_multicast:
             return
         elif data_packet.dstip.inNetwork('172.16.0.0/23'):
             Forwarding._handle_internal(event)
+            return 'internal'
         else:
             Forwarding._handle_external(event)
+            return 'external'
 
 def launch():
     core.registerNew(main)
@@ -226,7 +226,9 @@ class DHCP(object):
 
         cls.reply(event, reply)
 
+        cls.leases[src] = got_ip
         bucket.arp_table[got_ip] = ARPDets(event.dpid, event.port, src)
+        core.main._host_learned(got_ip)
 
     @classmethod
     def exec_release(cls, event, p, pool):
@@ -238,7 +240,8 @@ class DHCP(object):
             log.warn("%s tried to release unleased %s" % (src,p.ciaddr))
             return
         del cls.leases[p.chaddr]
-        del bucket.arp_table[p.chaddr]
+        bucket.arp_table.pop(p.ciaddr, None)
+        core.main._host_released(p.ciaddr)
         pool.append(p.ciaddr)
         log.info("%s released %s" % (src,p.ciaddr))
 
@@ -259,8 +262,12 @@ class ARP(object):
             cls.reply_arp(event, mac_addr)
         elif event.parsed.payload.opcode == pkt.arp.REPLY:
             # print('dapat reply dari ', event.parsed.payload.protosrc)
+            known = bucket.arp_table.get(event.parsed.payload.protosrc)
             bucket.arp_table[event.parsed.payload.protosrc] = ARPDets(event.dpid, event.port, \
                                                                       event.parsed.payload.hwsrc)
+            if known is None or (known.dpid, known.port, known.mac_addr) != \
+               (event.dpid, event.port, event.parsed.payload.hwsrc):
+                core.main._host_learned(event.parsed.payload.protosrc)
 
     @classmethod
     def reply_arp(cls, event, mac_addr):
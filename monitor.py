@@ -0,0 +1,168 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2015 haidlir
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+This component polls the statistics of the switches and keeps the history
+of the loads.
+"""
+
+from __future__ import print_function
+import random
+import time
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+from config import config
+from bucket import bucket
+from lib import TimeSeries
+
+class Poller(object):
+    """
+    Polls each switch on its own schedule. The first poll of a switch falls
+    at a random point of its interval, so the replies do not arrive in one
+    burst. Switches whose ports change or run near capacity are polled
+    faster, idle ones back off, and only a few requests wait at once.
+    """
+
+    tick = 0.1        # seconds between two looks at the schedule
+    due = {}          # dpid -> time of the next load poll
+    flow_due = {}     # dpid -> time of the next flow stats poll ('port' mode)
+    interval = {}     # dpid -> current load poll interval
+    loads = {}        # dpid -> port loads at the previous reply
+    outstanding = {}  # (dpid, kind) -> time the request was sent
+
+    @classmethod
+    def add(cls, dpid):
+        now = time.time()
+        cls.interval[dpid] = config.POLL_MIN_INTERVAL
+        cls.due[dpid] = now + random.uniform(0, config.POLL_MIN_INTERVAL)
+        cls.flow_due[dpid] = now + random.uniform(0, config.FLOW_STATS_INTERVAL)
+
+    @classmethod
+    def remove(cls, dpid):
+        for state in (cls.due, cls.flow_due, cls.interval, cls.loads):
+            state.pop(dpid, None)
+        for kind in ('flow', 'port'):
+            cls.outstanding.pop((dpid, kind), None)
+
+    @classmethod
+    def poll(cls):
+        now = time.time()
+        for key in list(cls.outstanding):
+            if now - cls.outstanding[key] > config.POLL_TIMEOUT:
+                del cls.outstanding[key] # the reply got lost
+        load_kind = 'port' if config.LOAD_MEASUREMENT == 'port' else 'flow'
+        for dpid in sorted(cls.due, key=cls.due.get):
+            if cls.due[dpid] > now:
+                break
+            if len(cls.outstanding) >= config.POLL_MAX_OUTSTANDING:
+                return
+            cls.due[dpid] = now + cls.interval[dpid]
+            cls.send(dpid, load_kind, now)
+        if load_kind == 'port':
+            for dpid in list(cls.flow_due):
+                if cls.flow_due[dpid] > now:
+                    continue
+                if len(cls.outstanding) >= config.POLL_MAX_OUTSTANDING:
+                    return
+                cls.flow_due[dpid] = now + config.FLOW_STATS_INTERVAL
+                cls.send(dpid, 'flow', now)
+
+    @classmethod
+    def send(cls, dpid, kind, now):
+        if (dpid, kind) in cls.outstanding:
+            return # the previous one is still on its way
+        if kind == 'port':
+            body = of.ofp_port_stats_request()
+        else:
+            body = of.ofp_flow_stats_request()
+        if core.openflow.sendToDPID(dpid, of.ofp_stats_request(body=body)):
+            cls.outstanding[(dpid, kind)] = now
+
+    @classmethod
+    def sent(cls, dpid, kind):
+        # when the request being answered went out; one given up on was sent
+        # more than POLL_TIMEOUT ago
+        return cls.outstanding.get((dpid, kind),
+                                   time.time() - config.POLL_TIMEOUT)
+
+    @classmethod
+    def replied(cls, dpid, kind):
+        cls.outstanding.pop((dpid, kind), None)
+        if dpid not in cls.interval or \
+           kind != ('port' if config.LOAD_MEASUREMENT == 'port' else 'flow'):
+            return
+        # every port counts, links as well as host and gateway ports
+        ports = bucket.port_info.get(dpid, {})
+        loads = dict((i, ports[i].upload) for i in ports)
+        previous = cls.loads.get(dpid, {})
+        cls.loads[dpid] = loads
+        busy = False
+        for i in loads:
+            capacity = ports[i].capacity
+            if loads[i] >= config.POLL_BUSY * capacity or \
+               abs(loads[i] - previous.get(i, 0.)) > config.POLL_CHANGE * capacity:
+                busy = True
+                break
+        if busy:
+            interval = cls.interval[dpid] / 2.
+        else:
+            interval = cls.interval[dpid] * 1.5
+        cls.interval[dpid] = min(max(interval, config.POLL_MIN_INTERVAL),
+                                 config.POLL_MAX_INTERVAL)
+
+class History(object):
+    """
+    Load history of every port and link, sampled each second into rings of
+    fixed size at several resolutions, so memory stays bounded however long
+    the controller runs.
+    """
+
+    @classmethod
+    def sample(cls):
+        if not config.HISTORY:
+            return
+        now = time.time()
+        for dpid in bucket.port_info:
+            for port_no in bucket.port_info[dpid]:
+                cls.add(('port', dpid, port_no), now,
+                        bucket.port_info[dpid][port_no].upload)
+        for dpid in bucket.matrix_adj:
+            for dpid_next in bucket.matrix_adj[dpid]:
+                cls.add(('link', dpid, dpid_next), now,
+                        bucket.matrix_adj[dpid][dpid_next].load)
+
+    @classmethod
+    def add(cls, key, t, value):
+        if key not in bucket.history:
+            bucket.history[key] = TimeSeries(config.HISTORY_RESOLUTIONS)
+        bucket.history[key].add(t, value)
+
+    @classmethod
+    def export(cls, filename):
+        # one line per stored step: kind, ends, step, start time, mean, peak
+        with open(filename, 'w') as f:
+            for key in sorted(bucket.history):
+                for ring in bucket.history[key].rings:
+                    for t, mean, peak in ring.series():
+                        f.write('%s %s %s %s %d %s %s\n' % (key + (ring.step, t,
+                                                                 mean, peak)))
@@ -25,33 +25,127 @@ This component provides routing function for the application
 """
 
 from __future__ import print_function
+from collections import deque
+import heapq
+import math
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from pox.core import core
+from config import config
 from bucket import bucket
 
 from lib import OneWayPath
 
+def findOneSourceWay(task):
+    # entry point of the routing worker processes, one task per source
+    name, matrix, origin, k, max_hop = task
+    try:
+        if name == 'KSP':
+            return origin, KSP.findOneSourceWay(matrix, origin, k, max_hop)
+        return origin, DFS.findOneSourceWay(matrix, origin)
+    except Exception as e:
+        print('routing worker failed on %s: %s' % (origin, e))
+        return origin, None
+
 class DFS(object):
     
     @classmethod
     def findAllPairsPath(cls, matrix):
         path = {}
-        def findOneSourcePath(now, origin, way = []):
+        for i in matrix:
+            path[i] = cls.toPath(i, cls.findOneSourceWay(matrix, i))
+        return path
+
+    @classmethod
+    def findOneSourceWay(cls, matrix, origin):
+        # hop tuples of every path from origin, keyed by destination
+        ways = {}
+        def findOneSourcePath(now, way, used):
             for i in matrix[now]:
-                if i in way or i == origin:
+                if i in used:
                     continue
-                else:
-                    if i not in path[origin]:
-                        path[origin][i] = [OneWayPath(way + [i], origin)]
-                    else:
-                        path[origin][i].append(OneWayPath(way + [i], origin))
-                    findOneSourcePath(i, origin, way + [i])
+                used.add(i)
+                way.append(i)
+                ways.setdefault(i, []).append(tuple(way))
+                findOneSourcePath(i, way, used)
+                way.pop()
+                used.discard(i)
 
-        for i in matrix:
-            path[i] = {}
-            findOneSourcePath(i, i)
+        findOneSourcePath(origin, [], set([origin]))
+        return ways
+
+    @classmethod
+    def toPath(cls, origin, ways):
+        path = {}
+        for i in ways:
+            path[i] = [OneWayPath(way, origin) for way in ways[i]]
         return path
 
+    @classmethod
+    def addLink(cls, matrix, path_list, dpid1, dpid2):
+        # every new path is a simple path ending at dpid1 (the prefix)
+        # followed by the new link and a simple path starting at dpid2
+        reverse = {}
+        for i in matrix:
+            for j in matrix[i]:
+                reverse.setdefault(j, []).append(i)
+
+        def findSuffix(origin, way, used):
+            cls.addPath(path_list, OneWayPath(way, origin))
+            for i in matrix.get(way[-1], {}):
+                if i not in used:
+                    used.add(i)
+                    way.append(i)
+                    findSuffix(origin, way, used)
+                    way.pop()
+                    used.discard(i)
+
+        def findPrefix(origin, way, used):
+            findSuffix(origin, way + [dpid2], used)
+            for i in reverse.get(origin, []):
+                if i not in used:
+                    used.add(i)
+                    findPrefix(i, [origin] + way, used)
+                    used.discard(i)
+
+        findPrefix(dpid1, [], set([dpid1, dpid2]))
+
+    @classmethod
+    def removeLink(cls, matrix, path_list, dpid1, dpid2):
+        return cls.removePath(path_list,
+                              bucket.link_path.get((dpid1, dpid2), ()))
+
+    @classmethod
+    def removeSwitch(cls, matrix, path_list, dpid):
+        affected = cls.removePath(path_list,
+                                  bucket.switch_path.get(dpid, ()))
+        path_list.pop(dpid, None)
+        return [(i, j) for i, j in affected if dpid not in (i, j)]
+
+    @classmethod
+    def addPath(cls, path_list, way):
+        path_list.setdefault(way.source, {}).setdefault(way.path[-1], []).append(way)
+        PathIndex.add(way)
+
+    @classmethod
+    def removePath(cls, path_list, ways):
+        broken = {}
+        for way in list(ways):
+            broken.setdefault((way.source, way.path[-1]), set()).add(way)
+            PathIndex.discard(way)
+        for i, j in broken:
+            if j not in path_list.get(i, {}):
+                continue
+            path_list[i][j] = [k for k in path_list[i][j] if k not in broken[(i, j)]]
+            if not path_list[i][j]:
+                del path_list[i][j]
+        return list(broken)
+
     @classmethod
     def getPath(cls, src, dst):
         temp_metric = None
@@ -64,24 +158,481 @@ class DFS(object):
             elif temp_metric > metric_i:
                 temp_metric = metric_i
                 temp_path = i.path
-        return temp_path
+        return list(temp_path)
 
     @classmethod
     def getPath_SNH(cls, src, dst):
-        temp_metric = None
-        temp_path = []
-        for i in bucket.path_list[src][dst]:
-            metric_i = i.get_metric_SNH()
-            if temp_metric == None:
-                temp_metric = metric_i
-                temp_path = i.path
-            elif temp_metric < metric_i:
-                temp_metric = metric_i
-                temp_path = i.path
-        return temp_path
+        if VectorMetric.available():
+            return list(VectorMetric.best(src, dst).path)
+        return list(PathRank.best(src, dst).path)
+
+    @classmethod
+    def getRanked_SNH(cls, src, dst):
+        # (path, bottleneck residual capacity) of the pair, widest first
+        if VectorMetric.available():
+            return sorted(VectorMetric.metrics(src, dst),
+                          key=lambda item: (-item[1], len(item[0].path)))
+        return [(way, way.get_metric_SNH()) for way in PathRank.ranked(src, dst)]
+
+    @classmethod
+    def getMetric_SNH(cls, src, dst):
+        # (path, bottleneck residual capacity) of every path of the pair
+        if VectorMetric.available():
+            return VectorMetric.metrics(src, dst)
+        return [(way, way.get_metric_SNH()) for way in bucket.path_list[src][dst]]
+
+class KSP(DFS):
+    """
+    Keeps only the K shortest loop-free paths (in hop count) of each switch
+    pair, found by Yen's algorithm, instead of every simple path.
+    """
+
+    @classmethod
+    def findOneSourceWay(cls, matrix, origin, k = None, max_hop = None):
+        if k is None:
+            k = config.KSP_K
+        if max_hop is None:
+            max_hop = config.KSP_MAX_HOP
+        ways = {}
+        for i in matrix:
+            if i == origin:
+                continue
+            found = cls.findKPath(matrix, origin, i, k, max_hop)
+            if found:
+                ways[i] = [tuple(way[1:]) for way in found]
+        return ways
+
+    @classmethod
+    def addLink(cls, matrix, path_list, dpid1, dpid2):
+        # only pairs for which a path over the new link can beat the
+        # longest path they keep now are searched again
+        to_dpid1 = cls.findDistance(matrix, dpid1, config.KSP_MAX_HOP, True)
+        from_dpid2 = cls.findDistance(matrix, dpid2, config.KSP_MAX_HOP)
+        for i in to_dpid1:
+            if i == dpid2:
+                continue
+            for j in from_dpid2:
+                if j == i or j == dpid1:
+                    continue
+                hop = to_dpid1[i] + 1 + from_dpid2[j]
+                if hop > config.KSP_MAX_HOP:
+                    continue
+                ways = path_list.get(i, {}).get(j, [])
+                if len(ways) < config.KSP_K or \
+                   hop < max(len(k.path) for k in ways):
+                    cls.updatePair(matrix, path_list, i, j)
+
+    @classmethod
+    def removeLink(cls, matrix, path_list, dpid1, dpid2):
+        affected = super(KSP, cls).removeLink(matrix, path_list, dpid1, dpid2)
+        for i, j in affected:
+            cls.updatePair(matrix, path_list, i, j)
+        return affected
+
+    @classmethod
+    def removeSwitch(cls, matrix, path_list, dpid):
+        affected = super(KSP, cls).removeSwitch(matrix, path_list, dpid)
+        for i, j in affected:
+            cls.updatePair(matrix, path_list, i, j)
+        return affected
+
+    @classmethod
+    def updatePair(cls, matrix, path_list, src, dst):
+        for way in path_list.get(src, {}).pop(dst, []):
+            PathIndex.discard(way)
+        for way in cls.findKPath(matrix, src, dst, config.KSP_K, config.KSP_MAX_HOP):
+            cls.addPath(path_list, OneWayPath(way[1:], src))
+
+    @classmethod
+    def findDistance(cls, matrix, src, max_hop, reverse = False):
+        if reverse:
+            neighbour = {}
+            for i in matrix:
+                for j in matrix[i]:
+                    neighbour.setdefault(j, []).append(i)
+        else:
+            neighbour = matrix
+        hop = {src: 0}
+        queue = deque([src])
+        while queue:
+            now = queue.popleft()
+            if hop[now] == max_hop:
+                continue
+            for i in neighbour.get(now, []):
+                if i not in hop:
+                    hop[i] = hop[now] + 1
+                    queue.append(i)
+        return hop
+
+    @classmethod
+    def findShortestPath(cls, matrix, src, dst, max_hop, banned_node = (),
+                         banned_link = ()):
+        prev = {src: None}
+        hop = {src: 0}
+        queue = deque([src])
+        while queue:
+            now = queue.popleft()
+            if now == dst:
+                break
+            if hop[now] == max_hop:
+                continue
+            for i in matrix.get(now, {}):
+                if i in prev or i in banned_node or (now, i) in banned_link:
+                    continue
+                prev[i] = now
+                hop[i] = hop[now] + 1
+                queue.append(i)
+        if dst not in prev:
+            return None
+        way = []
+        while dst is not None:
+            way.append(dst)
+            dst = prev[dst]
+        way.reverse()
+        return way
+
+    @classmethod
+    def findKPath(cls, matrix, src, dst, k, max_hop):
+        first = cls.findShortestPath(matrix, src, dst, max_hop)
+        if first is None:
+            return []
+        found = [first]
+        seen = set([tuple(first)])
+        candidate = []
+        while len(found) < k:
+            last = found[-1]
+            for n in range(len(last)-1):
+                root = last[:n+1]
+                banned_link = set()
+                for way in found:
+                    if way[:n+1] == root:
+                        banned_link.add((way[n], way[n+1]))
+                spur = cls.findShortestPath(matrix, last[n], dst, max_hop - n,
+                                            set(root[:-1]), banned_link)
+                if spur is None:
+                    continue
+                way = root[:-1] + spur
+                if tuple(way) in seen:
+                    continue
+                seen.add(tuple(way))
+                heapq.heappush(candidate, (len(way), way))
+            if not candidate:
+                break
+            found.append(heapq.heappop(candidate)[1])
+        return found
 
 class Djisktra(object):
-    
+    """
+    Searches the widest path (the one with the biggest bottleneck residual
+    capacity) on demand, straight from the adjacency matrix.
+    """
+
+    @classmethod
+    def findWidestPath(cls, matrix, source, destination):
+        # the widest bottleneck first, then the fewest hops among the paths
+        # that keep it; a single search ordered by (width, hops) can settle
+        # a switch through a longer way too early
+        width = {source: float('inf')}
+        done = set()
+        queue = [(-width[source], source)]
+        while queue:
+            now_width, now = heapq.heappop(queue)
+            if now in done:
+                continue
+            done.add(now)
+            if now == destination:
+                break
+            for i in matrix.get(now, {}):
+                if i in done:
+                    continue
+                width_i = min(-now_width, matrix[now][i].residual_capacity())
+                if i not in width or width_i > width[i]:
+                    width[i] = width_i
+                    heapq.heappush(queue, (-width_i, i))
+
+        if destination not in done:
+            return None, None
+        widest = width[destination]
+        prev = {source: None}
+        queue = deque([source])
+        while queue and destination not in prev:
+            now = queue.popleft()
+            for i in matrix.get(now, {}):
+                if i not in prev and matrix[now][i].residual_capacity() >= widest:
+                    prev[i] = now
+                    queue.append(i)
+        way = []
+        now = destination
+        while now != source:
+            way.append(now)
+            now = prev[now]
+        way.reverse()
+        return widest, way
+
     @classmethod
     def findPath(cls, matrix, source, destination):
-        pass
+        return cls.findWidestPath(matrix, source, destination)[1]
+
+    @classmethod
+    def getPath(cls, src, dst):
+        return cls.findPath(bucket.matrix_adj, src, dst)
+
+class Multipath(object):
+    """
+    Spreads flows of a switch pair over its MULTIPATH_K widest paths, each
+    with a share proportional to its residual capacity. The choice is a
+    weighted rendezvous hash of the flow key, so the same flow always
+    lands on the same path while the weights stay the same.
+    """
+
+    @classmethod
+    def getPath(cls, src, dst, key):
+        candidate = DFS.getRanked_SNH(src, dst)[:config.MULTIPATH_K]
+        ways = dict((way.path, way) for way, metric in candidate)
+        chosen = cls.choose(key, [(way.path, metric) for way, metric in candidate])
+        return list(ways[chosen].path)
+
+    @classmethod
+    def choose(cls, key, candidate):
+        # candidate is a list of (tag, weight), best first
+        best = None
+        best_score = None
+        for tag, weight in candidate:
+            if weight <= 0:
+                continue
+            digest = zlib.crc32(('%s|%s' % (key, tag)).encode()) & 0xffffffff
+            score = -weight / math.log((digest + 0.5) / 2.**32)
+            if best_score is None or score > best_score:
+                best = tag
+                best_score = score
+        if best is None:
+            return candidate[0][0] # every candidate is full
+        return best
+
+class Gateway(object):
+    """
+    Picks the gateway of outbound flows. For each ingress switch it caches
+    the available gateways ranked by min(path residual capacity, gateway
+    residual capacity), until loads, paths, topology or a gateway change.
+    """
+
+    @classmethod
+    def get_gw(cls, dpid, key):
+        # returns the gateway dpid and the path towards it
+        candidate = cls.ranked(dpid)[:config.GATEWAY_K]
+        if not candidate:
+            return None, None
+        paths = dict((gw, path) for gw, path, score in candidate)
+        gw = Multipath.choose(key, [(gw, score) for gw, path, score in candidate])
+        return gw, list(paths[gw])
+
+    @classmethod
+    def ranked(cls, dpid):
+        stamp = (bucket.load_epoch, bucket.path_version,
+                 bucket.topology_version, bucket.gateway_epoch)
+        cached = bucket.gateway_table.get(dpid)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        candidate = []
+        for gw in bucket.gateway:
+            if not bucket.gateway[gw].available:
+                continue
+            if gw == dpid:
+                width, path = float('inf'), []
+            else:
+                width, path = cls.findPath(dpid, gw)
+            if path is None:
+                continue
+            score = min(width, bucket.gateway[gw].residual_capacity())
+            candidate.append((gw, path, score))
+        candidate.sort(key=lambda item: (-item[2], len(item[1])))
+        bucket.gateway_table[dpid] = (stamp, candidate)
+        return candidate
+
+    @classmethod
+    def findPath(cls, src, dst):
+        if config.LOCAL_ROUTING == 'Djisktra':
+            return Djisktra.findWidestPath(bucket.matrix_adj, src, dst)
+        try:
+            way, width = DFS.getRanked_SNH(src, dst)[0]
+        except (KeyError, IndexError):
+            return None, None
+        return width, way.path
+
+class PathIndex(object):
+    """
+    Keeps, for every directed link and every switch, the paths of
+    bucket.path_list using it, so a failure only touches those paths.
+    """
+
+    @classmethod
+    def rebuild(cls, path_list):
+        bucket.link_path = {}
+        bucket.switch_path = {}
+        bucket.path_rank = {}
+        bucket.path_refs = {}
+        bucket.path_version += 1
+        for i in path_list:
+            for j in path_list[i]:
+                for way in path_list[i][j]:
+                    cls.add(way)
+
+    @classmethod
+    def add(cls, way):
+        bucket.path_version += 1
+        PathRank.invalidatePair(way.source, way.path[-1])
+        for link in way.links():
+            bucket.link_path.setdefault(link, set()).add(way)
+        bucket.switch_path.setdefault(way.source, set()).add(way)
+        for i in way.path:
+            bucket.switch_path.setdefault(i, set()).add(way)
+        bucket.path_refs[way.path] = bucket.path_refs.get(way.path, 0) + 1
+
+    @classmethod
+    def discard(cls, way):
+        bucket.path_version += 1
+        PathRank.invalidatePair(way.source, way.path[-1])
+        for link in way.links():
+            cls._discard(bucket.link_path, link, way)
+        cls._discard(bucket.switch_path, way.source, way)
+        for i in way.path:
+            cls._discard(bucket.switch_path, i, way)
+        # the interned tuple goes once no path uses it any more
+        refs = bucket.path_refs.get(way.path)
+        if refs is None:
+            return
+        if refs > 1:
+            bucket.path_refs[way.path] = refs - 1
+        else:
+            del bucket.path_refs[way.path]
+            bucket.path_pool.pop(way.path, None)
+
+    @classmethod
+    def _discard(cls, index, key, way):
+        ways = index.get(key)
+        if ways is None:
+            return
+        ways.discard(way)
+        if not ways:
+            del index[key]
+
+class PathRank(object):
+    """
+    Keeps the paths of each switch pair sorted by bottleneck residual
+    capacity, widest first. A load change on a link only drops the ranking
+    of the pairs whose paths cross it; those are sorted again on next use.
+    """
+
+    @classmethod
+    def ranked(cls, src, dst):
+        ways = bucket.path_rank.get((src, dst))
+        if ways is None:
+            ways = sorted(bucket.path_list[src][dst],
+                          key=lambda way: (-way.get_metric_SNH(), len(way.path)))
+            bucket.path_rank[(src, dst)] = ways
+        return ways
+
+    @classmethod
+    def best(cls, src, dst):
+        return cls.ranked(src, dst)[0]
+
+    @classmethod
+    def invalidatePair(cls, src, dst):
+        bucket.path_rank.pop((src, dst), None)
+
+    @classmethod
+    def invalidateLink(cls, dpid, dpid_next):
+        for way in bucket.link_path.get((dpid, dpid_next), ()):
+            bucket.path_rank.pop((way.source, way.path[-1]), None)
+
+class VectorMetric(object):
+    """
+    Keeps capacity and load of every link in NumPy arrays and every path as
+    a padded row of link columns, so the bottleneck of all paths is one
+    vectorized operation per load epoch. Used instead of PathRank when
+    config.USE_NUMPY is set and NumPy is installed.
+    """
+
+    link_index = {}   # (dpid, dpid_next) -> column
+    capacity = None
+    load = None
+    ways = []         # row -> OneWayPath
+    pair_row = {}     # (src, dst) -> (first row, last row + 1)
+    hop_index = None  # link columns of each path, padded with a spare column
+    hops = None       # hop count of each path
+    bottleneck = None
+    best_row = {}     # (src, dst) -> row of the widest path
+    path_version = None
+    load_epoch = None
+
+    @classmethod
+    def available(cls):
+        return config.USE_NUMPY and numpy is not None
+
+    @classmethod
+    def encode(cls):
+        cls.link_index = {}
+        for i in bucket.matrix_adj:
+            for j in bucket.matrix_adj[i]:
+                cls.link_index[(i, j)] = len(cls.link_index)
+        # the spare column never limits a path
+        cls.capacity = numpy.empty(len(cls.link_index) + 1)
+        cls.load = numpy.zeros(len(cls.link_index) + 1)
+        cls.capacity[-1] = numpy.inf
+        for (i, j), n in cls.link_index.items():
+            cls.capacity[n] = bucket.matrix_adj[i][j].capacity
+            cls.load[n] = bucket.matrix_adj[i][j].load
+
+        rows = []
+        cls.ways = []
+        cls.pair_row = {}
+        for i in bucket.path_list:
+            for j in bucket.path_list[i]:
+                first = len(rows)
+                for way in bucket.path_list[i][j]:
+                    rows.append([cls.link_index[link] for link in way.links()])
+                    cls.ways.append(way)
+                cls.pair_row[(i, j)] = (first, len(rows))
+        width = max([len(row) for row in rows] + [1])
+        cls.hop_index = numpy.full((len(rows), width), len(cls.link_index),
+                                   dtype=numpy.intp)
+        for n, row in enumerate(rows):
+            cls.hop_index[n, :len(row)] = row
+        cls.hops = numpy.array([len(row) for row in rows], dtype=numpy.intp)
+        cls.path_version = bucket.path_version
+        cls.load_epoch = None
+
+    @classmethod
+    def updateLink(cls, dpid, dpid_next):
+        n = cls.link_index.get((dpid, dpid_next))
+        if n is not None and cls.path_version == bucket.path_version:
+            cls.load[n] = bucket.matrix_adj[dpid][dpid_next].load
+
+    @classmethod
+    def evaluate(cls):
+        if cls.path_version != bucket.path_version:
+            cls.encode()
+        if cls.load_epoch != bucket.load_epoch:
+            residual = cls.capacity - cls.load
+            cls.bottleneck = residual[cls.hop_index].min(axis=1)
+            cls.best_row = {}
+            cls.load_epoch = bucket.load_epoch
+
+    @classmethod
+    def best(cls, src, dst):
+        cls.evaluate()
+        row = cls.best_row.get((src, dst))
+        if row is None:
+            # widest first, then fewest hops, like PathRank
+            first, last = cls.pair_row[(src, dst)]
+            row = first + int(numpy.lexsort((cls.hops[first:last],
+                                             -cls.bottleneck[first:last]))[0])
+            cls.best_row[(src, dst)] = row
+        return cls.ways[row]
+
+    @classmethod
+    def metrics(cls, src, dst):
+        cls.evaluate()
+        first, last = cls.pair_row[(src, dst)]
+        return [(cls.ways[n], float(cls.bottleneck[n])) for n in range(first, last)]